@@ -1,5 +1,6 @@
-import re, math, mido, queue, sounddevice
+import re, collections, mido, sounddevice, threading
 import numpy as np
+from numba import njit
 
 # Print MIDI note events if True.
 log_notes = True
@@ -7,6 +8,21 @@ log_notes = True
 # Print envelope events if True.
 log_envelope = True
 
+# Messages logged from the output callback are queued here
+# and printed by the main thread, since printing from the
+# callback can cause underruns on a slow terminal. The
+# oldest messages are dropped if printing falls behind.
+log_messages = collections.deque(maxlen=256)
+
+# Queue a message to be printed by the main thread.
+def log(*args):
+    log_messages.append(args)
+
+# Print and remove all queued messages.
+def print_log():
+    while log_messages:
+        print(*log_messages.popleft())
+
 # Sample rate in sps. This doesn't need to be fixed: it
 # could be set to the preferred rate of the audio output.
 sample_rate = 48000
@@ -44,184 +60,269 @@ if controller_name is None:
 else:
     controller = mido.open_input(controller_name)
 
-# Return a sine wave of frequency f.
-def make_sin(f):
-    period = sample_rate / f
-    # Need enough cycles to be able to wrap around when
-    # generating a block.
-    ncycles = math.ceil(blocksize / period)
-    nsin = round(ncycles * period)
-    t_period = np.linspace(0, ncycles * (2 * np.pi), nsin, dtype=np.float32)
-    # Allow for eight notes before clipping.
-    return 0.125 * np.sin(t_period)
-
-# Precalculate wave tables
-notes = []
-for note in range(128):
-    f = 440 * 2 ** ((note - 69) / 12)
-    notes.append(make_sin(f))
-
-class Note:
-    def __init__(self, key):
-        self.t = 0
-        self.key = key
-        self.release_rate = None
-        # Hardwire to 20ms for now.
-        attack_samples = 10 * sample_rate / 1000
-        self.attack_rate = 1.0 / attack_samples
-        self.attack_amplitude = 0
-        self.wave_table = notes[key]
-        self.held = False
-    
-    # Returns a requested block of samples.
-    def play(self, frame_count):
-        # Cache some state.
-        wave_table = self.wave_table
-        t_output = self.t
-
-        # Wrap the output as needed.
-        nwave_table = len(wave_table)
-        t_start = t_output % nwave_table
-        t_end = (t_output + frame_count) % nwave_table
-        if t_start < t_end:
-            output = wave_table[t_start:t_end]
-        else:
-            output = np.append(wave_table[t_start:], wave_table[:t_end])
+# One cycle of a sine wave, shared by all notes. Notes are
+# rendered by stepping a fractional phase through the table
+# at a per-key rate and interpolating between neighboring
+# entries, so every key is exactly in tune. The table size
+# must be a power of two.
+sin_table_size = 4096
+t_period = np.arange(sin_table_size) * (2 * np.pi / sin_table_size)
+# Allow for eight notes before clipping.
+sin_table = (0.125 * np.sin(t_period)).astype(np.float32)
+
+# Frequency in Hz of each MIDI key, equal-tempered with
+# key 69 at A440.
+key_frequencies = 440 * np.exp2((np.arange(128) - 69) / 12)
+
+# Per-key phase increments in table entries per sample.
+phase_increments = key_frequencies * (sin_table_size / sample_rate)
+
+# Per-key note state, one array entry per MIDI key. A note
+# is attacking while its attack rate is nonzero and
+# releasing once its release rate is nonzero.
+note_active = np.zeros(128, dtype=np.bool_)
+note_held = np.zeros(128, dtype=np.bool_)
+note_t = np.zeros(128, dtype=np.int64)
+note_phase = np.zeros(128, dtype=np.float64)
+attack_amplitude = np.zeros(128, dtype=np.float32)
+attack_rate = np.zeros(128, dtype=np.float32)
+release_amplitude = np.zeros(128, dtype=np.float32)
+release_rate = np.zeros(128, dtype=np.float32)
+
+# Envelope events reported by render_notes(), as (event,
+# key, t) rows. Each key can finish its attack and finish
+# its note at most once per block.
+ATTACK_FINISHED = 0
+NOTE_FINISHED = 1
+envelope_events = np.zeros((2 * 128, 3), dtype=np.int64)
+
+# Sustain pedal is held.
+sustaining = False
+
+# Start the note for key, replacing any note already
+# playing there.
+def start_note(key):
+    note_t[key] = 0
+    note_phase[key] = 0.0
+    # Hardwire to 20ms for now.
+    attack_samples = 10 * sample_rate / 1000
+    attack_amplitude[key] = 0.0
+    attack_rate[key] = 1.0 / attack_samples
+    release_amplitude[key] = 1.0
+    release_rate[key] = 0.0
+    note_held[key] = sustaining
+    note_active[key] = True
+
+# Mark the note as released and start the release timer.
+def release_note(key):
+    if not note_active[key]:
+        return
+    if log_envelope:
+        log("releasing note", key, note_t[key])
+    # Hardcode release time to 100ms
+    release_samples = 100 * sample_rate / 1000
+    release_rate[key] = 1.0 / release_samples
+    release_amplitude[key] = 1.0
+    if attack_rate[key]:
+        release_amplitude[key] = attack_amplitude[key]
+        attack_rate[key] = 0.0
+
+# Mix frame_count samples of the active notes into out,
+# advancing their state. Each note's sine table read and
+# attack and release envelopes are fused into one compiled
+# loop: at small blocksizes the per-call overhead of
+# separate NumPy passes dominates the arithmetic. The GIL
+# is released while rendering so that the MIDI callback can
+# keep running. Returns the number of rows written to
+# events.
+@njit(cache=True, fastmath=True, nogil=True)
+def render_notes(
+    frame_count,
+    sin_table,
+    phase_increments,
+    note_active,
+    note_held,
+    note_t,
+    note_phase,
+    attack_amplitude,
+    attack_rate,
+    release_amplitude,
+    release_rate,
+    out,
+    events,
+):
+    mask = len(sin_table) - 1
+    # Envelope and sample arithmetic is done in float32 to
+    # match the output; mixing in float64 values or
+    # literals would silently promote it. Only the phase
+    # needs float64, for pitch accuracy.
+    zero = np.float32(0.0)
+    one = np.float32(1.0)
+    nevents = 0
+    # Scanning the active flags here is cheaper than
+    # building an index array of active keys per block.
+    for key in range(len(note_active)):
+        if not note_active[key]:
+            continue
+        t = note_t[key]
 
         # Handle release as needed.
-        if self.release_rate and not self.held:
-            if self.release_amplitude <= 0:
-                if log_envelope:
-                    print("finishing note", self.key, self.t)
-                return None
-            end_amplitude = \
-                self.release_amplitude - frame_count * self.release_rate
-            scale = np.linspace(
-                self.release_amplitude,
-                end_amplitude,
-                frame_count,
-            ).clip(0, 1)
-            output = output * scale
-            self.release_amplitude = np.max(end_amplitude, 0)
-            
+        rel_a, rel_r = one, zero
+        if release_rate[key] and not note_held[key]:
+            if release_amplitude[key] <= 0:
+                events[nevents] = (NOTE_FINISHED, key, t)
+                nevents += 1
+                note_active[key] = False
+                continue
+            rel_a, rel_r = release_amplitude[key], release_rate[key]
+            release_amplitude[key] = max(rel_a - frame_count * rel_r, zero)
+
         # Handle attack as needed.
-        if self.attack_rate:
-            end_amplitude = \
-                self.attack_amplitude + frame_count * self.attack_rate
-            scale = np.linspace(
-                self.attack_amplitude,
-                end_amplitude,
-                frame_count,
-            ).clip(0, 1)
-            output = output * scale
+        att_a, att_r = one, zero
+        if attack_rate[key]:
+            att_a, att_r = attack_amplitude[key], attack_rate[key]
+            end_amplitude = att_a + frame_count * att_r
             if end_amplitude >= 1:
-                if log_envelope:
-                    print("finishing attack", self.key, self.t)
-                self.attack_rate = None
+                events[nevents] = (ATTACK_FINISHED, key, t)
+                nevents += 1
+                attack_rate[key] = 0.0
             else:
-                self.attack_amplitude = end_amplitude
-
-        # Get the samples.
-        self.t += frame_count
-        return output
-
-    # Mark the note as released and start the release timer.
-    def release(self):
-        if log_envelope:
-            print("releasing note", self.key, self.t)
-        # Hardcode release time to 100ms
-        release_samples = 100 * sample_rate / 1000
-        self.release_rate = 1.0 / release_samples
-        self.release_amplitude = 1.0
-        if self.attack_rate:
-            self.release_amplitude = self.attack_amplitude
-            self.attack_rate = None
-
-    # Mark the current note as held by sustain pedal.
-    def hold(self):
-        self.held = True
-    
-    # Mark the current note as no longer held by sustain pedal.
-    def unhold(self):
-        self.held = False
-
-# Currently playing notes.
-current_notes = dict()
-
-# Queue of MIDI messages for state changes.
-command_queue = queue.SimpleQueue()
+                attack_amplitude[key] = end_amplitude
 
-# Sustain pedal is held.
-sustaining = False
+        # Mix in the enveloped samples.
+        phase = note_phase[key]
+        increment = phase_increments[key]
+        for i in range(frame_count):
+            ramp = np.float32(i)
+            attack = min(att_a + ramp * att_r, one)
+            release = min(max(rel_a - ramp * rel_r, zero), one)
+            index = int(phase)
+            frac = np.float32(phase - index)
+            sample = sin_table[index & mask] * (one - frac) + \
+                sin_table[(index + 1) & mask] * frac
+            out[i] += sample * attack * release
+            phase += increment
+        note_t[key] = t + frame_count
+        # Wrap the phase to keep its fractional precision.
+        note_phase[key] = phase % len(sin_table)
+    return nevents
+
+# Commands for state changes, passed from the MIDI callback
+# to the output callback as (command, key, value) rows in a
+# fixed-size ring. There is exactly one writer, which only
+# advances command_tail, and one reader, which only
+# advances command_head, so no lock is needed: the writer
+# fills a row before publishing it by bumping the tail. This
+# keeps the output callback from blocking or allocating.
+#
+# The head and tail are row indices wrapped with a mask, so
+# they stay small however long the synth runs. One row is
+# always left empty so that a full ring can be told apart
+# from an empty one. The ring size must be a power of two.
+NOTE_ON = 0
+NOTE_OFF = 1
+SUSTAIN_PEDAL = 2
+command_ring = np.zeros((256, 3), dtype=np.int16)
+command_mask = len(command_ring) - 1
+command_head = 0
+command_tail = 0
+
+# Queue a command for the output callback.
+def send_command(command, key, value):
+    global command_tail
+    next_tail = (command_tail + 1) & command_mask
+    if next_tail == command_head:
+        print("command ring full: dropping command", command, key, value)
+        return
+    command_ring[command_tail] = (command, key, value)
+    command_tail = next_tail
+
+# Compile the renderer now rather than in the first output
+# callback.
+render_notes(
+    blocksize,
+    sin_table,
+    phase_increments,
+    note_active,
+    note_held,
+    note_t,
+    note_phase,
+    attack_amplitude,
+    attack_rate,
+    release_amplitude,
+    release_rate,
+    np.zeros(blocksize, dtype=np.float32),
+    envelope_events,
+)
 
 # This callback is called by `sounddevice` to get some
 # samples to output. It's the heart of sound generation in
-# the synth.
+# the synth. The stream is raw, so out_data is a bare
+# buffer of float32 samples rather than a NumPy array that
+# `sounddevice` would have to build on every call.
 def output_callback(out_data, frame_count, time_info, status):
-    global current_notes, command_queue, sustaining
+    global command_head, sustaining
 
     # A non-None status indicates that something has
     # happened with sound output that shouldn't have.  This
     # is almost always an underrun due to generating samples
     # too slowly.
     if status:
-        print("output callback:", status)
-
-    while not command_queue.empty():
-        mesg_type, mesg = command_queue.get()
-        if mesg_type == 'note_on':
-            key = mesg.note
-            new_note = Note(key)
-            if sustaining:
-                new_note.held = True
-            current_notes[key] = new_note
-        elif mesg_type == 'note_off':
-            key = mesg.note
-            current_notes[key].release()
-        elif mesg_type == 'sustain_pedal':
-            sustaining = mesg.value > 0
-            for note in current_notes.values():
-                if sustaining:
-                    note.hold()
-                else:
-                    note.unhold()
-        else:
-            raise Exception(f"bad message in command queue: {mesg_type} {mesg}")
-
-    # Mix samples from notes.
-    output = np.zeros(frame_count, dtype = np.float32)
-    finished_keys = []
-    for key, note in current_notes.items():
-        sound = note.play(frame_count)
-        if sound is None:
-            finished_keys.append(key)
-        else:
-            output += sound
+        log("output callback:", status)
 
-    # Remove finished notes.
-    for key in finished_keys:
-        del current_notes[key]
+    while command_head != command_tail:
+        command, key, value = command_ring[command_head]
+        command_head = (command_head + 1) & command_mask
+        if command == NOTE_ON:
+            start_note(key)
+        elif command == NOTE_OFF:
+            release_note(key)
+        elif command == SUSTAIN_PEDAL:
+            sustaining = value > 0
+            note_held[:] = sustaining
+        else:
+            raise Exception(f"bad command in command ring: {command} {key} {value}")
 
-    # Note that we need the out_data slicing to *replace*
-    # the data in the array.
-    out_data[:] = output.reshape(frame_count,1)
+    # Mix samples from notes directly into the output
+    # buffer, viewed in place as an array.
+    output = np.frombuffer(out_data, dtype=np.float32)
+    output.fill(0.0)
+    nevents = render_notes(
+        frame_count,
+        sin_table,
+        phase_increments,
+        note_active,
+        note_held,
+        note_t,
+        note_phase,
+        attack_amplitude,
+        attack_rate,
+        release_amplitude,
+        release_rate,
+        output,
+        envelope_events,
+    )
+    if log_envelope:
+        for event, key, t in envelope_events[:nevents]:
+            if event == ATTACK_FINISHED:
+                log("finishing attack", key, t)
+            else:
+                log("finishing note", key, t)
 
 # Start audio playing. Must keep up with output from here on.
-output_stream = sounddevice.OutputStream(
+output_stream = sounddevice.RawOutputStream(
     samplerate=sample_rate,
     channels=1,
+    dtype='float32',
     blocksize=blocksize,
     callback=output_callback,
 )
 output_stream.start()
 
-# Block waiting for the controller (keyboard) to send a MIDI
-# message, then handle it. Return False if the MIDI message
-# wants the instrument (synthesizer) to stop, True otherwise.
-def get_midi_event(controller):
-    # Block until a MIDI message is received.
-    mesg = controller.receive()
-
+# Handle a MIDI message sent by the controller (keyboard).
+# Return False if the MIDI message wants the instrument
+# (synthesizer) to stop, True otherwise.
+def handle_midi_event(mesg):
     # Select what to do based on message type.
     mesg_type = mesg.type
     # Special case: note on with velocity 0 indicates
@@ -235,7 +336,7 @@ def get_midi_event(controller):
         velocity = mesg.velocity / 127
         if log_notes:
             print('note on', key, mesg.velocity, round(velocity, 2))
-        command_queue.put((mesg_type, mesg))
+        send_command(NOTE_ON, key, mesg.velocity)
     # Remove a note from the sound. If it is already off,
     # this message will be ignored.
     elif mesg_type == 'note_off':
@@ -243,7 +344,7 @@ def get_midi_event(controller):
         velocity = round(mesg.velocity / 127, 2)
         if log_notes:
             print('note off', key, mesg.velocity, velocity)
-        command_queue.put((mesg_type, mesg))
+        send_command(NOTE_OFF, key, mesg.velocity)
     # Handle various controls.
     elif mesg.type == 'control_change':
         # XXX Hard-wired for "stop" key on Oxygen8.
@@ -261,7 +362,7 @@ def get_midi_event(controller):
         # Sustain pedal press / release.
         elif mesg.control == 64:
             print('sustain pedal', mesg.value)
-            command_queue.put(('sustain_pedal', mesg))
+            send_command(SUSTAIN_PEDAL, 0, mesg.value)
         # Unknown control changes are logged and ignored.
         else:
             print(f"control", mesg.control, mesg.value)
@@ -273,6 +374,19 @@ def get_midi_event(controller):
         print('unknown MIDI message', mesg)
     return True
 
-# Run the instrument until the controller stop key is pressed.
-while get_midi_event(controller):
-    pass
+# Set when the controller stop key is pressed.
+stopping = threading.Event()
+
+# This callback is called by `mido` on its own input thread
+# for each MIDI message, so messages are handled as soon as
+# they arrive rather than by a blocking receive loop.
+def midi_callback(mesg):
+    if not handle_midi_event(mesg):
+        stopping.set()
+
+# Run the instrument until the controller stop key is
+# pressed, printing logged messages every few milliseconds.
+controller.callback = midi_callback
+while not stopping.wait(0.01):
+    print_log()
+print_log()